@@ -13,9 +13,10 @@ Reads from an Excel File in the 'input/vars' folder, which includes the columns:
 ['varname', 'source_path', 'static', 'multiplier', 'use']
 """
 from Helper import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def finalizeVar(in_rast, out_rast, mask, mult=100):
+def finalizeVar(in_rast, out_rast, mask, mult=100, envs=None):
    """
    Finalize a raster predictor, clipping and masking to the provide mask, applying a multiplier and
    converting to integer.
@@ -23,27 +24,25 @@ def finalizeVar(in_rast, out_rast, mask, mult=100):
    :param out_rast: output raster
    :param mask: data mask
    :param mult: Multiplier to apply to dataset.
+   :param envs: Dictionary of arcpy environment settings, applied when running in a worker process
    :return: out_rast
    """
-
-   r = arcpy.sa.Raster(in_rast)
-   print('Finalizing raster ' + in_rast + '...')
-   if not r.isInteger:
-      if mult == 1:
-         print('Rounding values to integer...')
-         arcpy.sa.Int(r + 0.5).save('tmp_rast')
-      else:
-         print('Multiplying and rounding values to integer...')
-         arcpy.sa.Int(r * int(mult) + 0.5).save('tmp_rast')
-      arcpy.sa.ExtractByMask('tmp_rast', mask).save(out_rast)
-   else:
-      if mult == 1:
-         arcpy.sa.ExtractByMask(in_rast, mask).save(out_rast)
-      else:
+   with arcpy.EnvManager(**(envs or {})):
+      r = arcpy.sa.Raster(in_rast)
+      print('Finalizing raster ' + in_rast + '...')
+      # Values are transformed as a map algebra expression and passed directly to ExtractByMask, without saving
+      if not r.isInteger:
+         if mult == 1:
+            print('Rounding values to integer...')
+            r = arcpy.sa.Int(r + 0.5)
+         else:
+            print('Multiplying and rounding values to integer...')
+            r = arcpy.sa.Int(r * int(mult) + 0.5)
+      elif mult != 1:
          print('Multiplying values...')
-         arcpy.sa.Int(r * int(mult)).save('tmp_rast')
-         arcpy.sa.ExtractByMask('tmp_rast', mask).save(out_rast)
-   print('Created raster ' + out_rast + '.')
+         r = arcpy.sa.Int(r * int(mult))
+      arcpy.sa.ExtractByMask(r, mask).save(out_rast)
+      print('Created raster ' + out_rast + '.')
    return out_rast
 
 
@@ -67,15 +66,13 @@ def main():
    # Output folder (sub-folders for each processing year should be here)
    out_folder = r'D:\git\ConsVision_DevVulnModel\inputs\vars'
 
-   # Set environments
-   arcpy.env.overwriteOutput = True
-   arcpy.env.snapRaster = snap
-   arcpy.env.cellSize = snap
-   arcpy.env.outputCoordinateSystem = snap
-   arcpy.env.workspace = arcpy.env.scratchGDB
-   arcpy.env.extent = mask
+   # Environments, applied in the worker processes
+   envs = {'overwriteOutput': True, 'snapRaster': snap, 'cellSize': snap, 'outputCoordinateSystem': snap,
+           'workspace': arcpy.env.scratchGDB, 'extent': mask}
 
-   # Loop over table, skipping those marked use = 0.
+   # Loop over table, skipping those marked use = 0. Rasters to finalize are collected in jobs, then processed in
+   # parallel.
+   jobs = []
    for i in list(range(0, len(vars))):
       in_rast = vars['source_path'][i]
       if vars['use'][i] == 0:
@@ -85,7 +82,7 @@ def main():
       mult = vars['multiplier'][i]
       out_rast = out_folder + os.sep + years[0] + os.sep + nm + '.tif'
       if not arcpy.Exists(out_rast) or over:
-         finalizeVar(in_rast, out_rast, mask, mult)
+         jobs.append([in_rast, out_rast, mult])
       else:
          print('Skipping, `' + out_rast + '` already exists.')
       if vars['static'][i] != 1:
@@ -96,13 +93,19 @@ def main():
             continue
          out_rast = out_folder + os.sep + years[1] + os.sep + nm + '.tif'
          if not arcpy.Exists(out_rast) or over:
-            finalizeVar(in_rast, out_rast, mask, mult)
+            jobs.append([in_rast, out_rast, mult])
          else:
             print('Skipping, `' + out_rast + '` already exists.')
       else:
          # static variable (only one time period)
          print('Static variable.')
 
+   if len(jobs) > 0:
+      with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count())) as ex:
+         futures = [ex.submit(finalizeVar, j[0], j[1], mask, j[2], envs) for j in jobs]
+         for f in as_completed(futures):
+            f.result()
+
 
 if __name__ == '__main__':
    main()
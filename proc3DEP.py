@@ -1,8 +1,8 @@
 # ----------------------------------------------------------------------------------------
 # Proc3DEP.py
-# Version:  Python 2.7.5
+# Version:  ArcGIS Pro / Python 3.x
 # Creation Date: 2015-07-14
-# Last Edit: 2019-10-03
+# Last Edit: 2026-10-15
 # Creator:  Kirsten R. Hazler
 #
 # Summary:
@@ -25,19 +25,134 @@
 #     suf = '.zip'
 
 #     in_fld = 'FileCode_3DEP' (assuming this is from the index file I modified)
+#
+# Downloads use a pooled requests.Session (built on urllib3), so connections to the host are re-used across files.
 # ----------------------------------------------------------------------------------------
 
 # Import required modules
-import urllib
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+import shutil
+import tempfile
+import threading
 import zipfile
 from Helper import *
+try:
+   # If installed, ISA-L is used for faster DEFLATE decoding and CRC checks when extracting zip files (see IsalZip)
+   from isal import isal_zlib
+except ImportError:
+   isal_zlib = None
 
 
 # from arcpy.sa import *
 # arcpy.CheckOutExtension("Spatial")
 
 
-def BatchDownload(in_tab, in_fld, url, out_dir, pre='', suf=''):
+@contextmanager
+def IsalZip():
+   '''Context manager which makes zipfile use ISA-L for decompression and CRC checks, if isal is installed. zipfile
+   binds crc32 at import, so it is replaced separately from the decompressor. The standard library functions are
+   restored on exit, so zip files written elsewhere (which use zlib compression levels) are not affected.'''
+   if isal_zlib is None:
+      yield
+      return
+   zlib0, crc0 = zipfile.zlib, zipfile.crc32
+   zipfile.zlib, zipfile.crc32 = isal_zlib, isal_zlib.crc32
+   try:
+      yield
+   finally:
+      zipfile.zlib, zipfile.crc32 = zlib0, crc0
+
+
+def MakeSession(pool_size=8):
+   '''Creates a requests.Session with retries, so a connection to the host can be re-used between downloads.
+   Parameters:
+   - pool_size: Maximum number of connections to keep open to the host; should be at least the number of
+      concurrent downloads
+   '''
+   session = requests.Session()
+   retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+   session.mount('https://', HTTPAdapter(pool_maxsize=pool_size, max_retries=retry))
+   return session
+
+
+def DownloadFile(session, url, out_dir, fileName, chunk_size=4 << 20):
+   '''Downloads a single file, returning a message describing the result.
+   Parameters:
+   - session: requests.Session used for the download
+   - url: The web location containing the file to be downloaded
+   - out_dir: Output directory to store the downloaded file
+   - fileName: Name of the file to download
+   - chunk_size: Size (in bytes) of the chunks read from the response and written to the file
+   '''
+   try:
+      inFile = url + fileName
+      outFile = os.path.join(out_dir, fileName)
+
+      if os.path.exists(outFile):
+         # Skip the download if a complete copy of the file already exists, checking its size with a HEAD request
+         head = session.head(inFile, allow_redirects=True, timeout=10)
+         if head.status_code == 200 and head.headers.get('Content-Length') == str(os.path.getsize(outFile)):
+            printMsg('File already downloaded: %s.' % fileName)
+            return 'File already downloaded: %s' % fileName
+
+      with session.get(inFile, stream=True, timeout=(5, 60)) as rf:
+         if rf.status_code == 404:
+            printMsg('File does not exist: %s.' % fileName)
+            return 'File does not exist: %s' % fileName
+         rf.raise_for_status()
+         printMsg('Downloading %s. Patience please ...' % fileName)
+         with open(outFile, 'wb', buffering=chunk_size) as f:
+            for chunk in rf.iter_content(chunk_size=chunk_size):
+               f.write(chunk)
+            if hasattr(os, 'posix_fadvise'):
+               # Downloaded files are not read again here, so don't keep them in the page cache
+               f.flush()
+               os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+      return 'Successfully downloaded %s' % fileName
+   except:
+      printWrng('Failed to download %s ...' % fileName)
+      return 'Failed to download %s' % fileName
+
+
+def DownloadExtractFile(session, url, extract_dir, fileName, max_size=256 << 20, chunk_size=4 << 20, lock=None):
+   '''Downloads a single zip file and extracts its contents, without saving the zip file to disk. The download is
+   held in memory, unless it is larger than max_size, in which case it is spooled to a temporary file.
+   Returns a message describing the result.
+   Parameters:
+   - session: requests.Session used for the download
+   - url: The web location containing the file to be downloaded
+   - extract_dir: Output directory to store the extracted files
+   - fileName: Name of the zip file to download
+   - max_size: Maximum size (in bytes) of a download to hold in memory
+   - chunk_size: Size (in bytes) of the chunks read from the response
+   - lock: (optional) Lock held while extracting, when several downloads extract to the same directory
+   '''
+   try:
+      inFile = url + fileName
+
+      with session.get(inFile, stream=True, timeout=(5, 60)) as rf:
+         if rf.status_code == 404:
+            printMsg('File does not exist: %s.' % fileName)
+            return 'File does not exist: %s' % fileName
+         rf.raise_for_status()
+         printMsg('Downloading and extracting %s. Patience please ...' % fileName)
+         with tempfile.SpooledTemporaryFile(max_size=max_size) as buf:
+            for chunk in rf.iter_content(chunk_size=chunk_size):
+               buf.write(chunk)
+            buf.seek(0)
+            with lock or nullcontext(), IsalZip(), zipfile.ZipFile(buf) as zf:
+               zf.extractall(extract_dir)
+      return 'Successfully downloaded and extracted %s' % fileName
+   except:
+      printWrng('Failed to download and extract %s ...' % fileName)
+      return 'Failed to download and extract %s' % fileName
+
+
+def BatchDownload(in_tab, in_fld, url, out_dir, pre='', suf='', max_workers=8):
    '''Downloads a set of files specified in a table
    Parameters:
    - in_tab: Input table containing unique basenames for the files to be retrieved
@@ -46,55 +161,86 @@ def BatchDownload(in_tab, in_fld, url, out_dir, pre='', suf=''):
    - out_dir: Output directory to store downloaded files
    - pre: Filename prefix; optional
    - suf : Filename suffix; optional
+   - max_workers: Number of files to download concurrently; optional
    '''
 
    # Create and open a log file.
    # If this log file already exists, it will be overwritten.  If it does not exist, it will be created.
-   ProcLogFile = out_dir + os.sep + 'README.txt'
+   ProcLogFile = os.path.join(out_dir, 'README.txt')
    Log = open(ProcLogFile, 'w+')
-   FORMAT = '%Y-%m-%d %H:%M:%S'
-   timestamp = datetime.now().strftime(FORMAT)
+   timestamp = datetime.now().isoformat(sep=' ', timespec='seconds')
    Log.write("Process logging started %s \n" % timestamp)
 
-   fileList = []
-   # Make a list of the files to download, from the input table                                     
+   # Make a list of the files to download, from the input table
    try:
-      sc = arcpy.da.SearchCursor(in_tab, in_fld)
-      for row in sc:
-         fname = pre + row[0] + suf
-         fileList.append(fname)
+      with arcpy.da.SearchCursor(in_tab, [in_fld]) as sc:
+         fileList = [pre + row[0] + suf for row in sc]
    except:
       printErr('Unable to parse input table.  Exiting...')
       Log.write('Unable to parse input table.  Exiting...')
       quit()
 
+   # Use a single session for all files, so the connection to the host is re-used between downloads
+   session = MakeSession(max_workers)
+
    # Download the files and save to the output directory, while keeping track of success/failure
-   procList = []
-   for fileName in fileList:
-      try:
-         inFile = url + fileName
-         outFile = out_dir + os.sep + fileName
+   with ThreadPoolExecutor(max_workers=max_workers) as ex:
+      procList = list(ex.map(lambda f: DownloadFile(session, url, out_dir, f), fileList))
+   session.close()
 
-         rf = urllib.urlopen(inFile)
-         msg = rf.getcode()
-         rf.close()
+   # Write download results to log.
+   Log.write(''.join("%s\n" % item for item in procList))
 
-         if msg == 404:
-            printMsg('File does not exist: %s.' % fileName)
-            procList.append('File does not exist: %s' % fileName)
-         else:
-            printMsg('Downloading %s. Patience please ...' % fileName)
-            urllib.urlretrieve(inFile, outFile)
-            procList.append('Successfully downloaded %s' % fileName)
-      except:
-         printWrng('Failed to download %s ...' % fileName)
-         procList.append('Failed to download %s' % fileName)
+   timestamp = datetime.now().isoformat(sep=' ', timespec='seconds')
+   Log.write("\nProcess logging ended %s" % timestamp)
+   Log.close()
+
+   return
+
+
+def BatchDownloadExtract(in_tab, in_fld, url, extract_dir, pre='', suf='', max_workers=8):
+   '''Downloads a set of zip files specified in a table, extracting them directly to an output directory. Unlike
+   BatchDownload followed by BatchExtractZips, the zip files are not saved to disk. Use BatchDownload if the zip files
+   should be kept.
+   Parameters:
+   - in_tab: Input table containing unique basenames for the files to be retrieved
+   - in_fld: Field in the input table, containing the unique basename
+   - url: The web location containing the files to be downloaded
+   - extract_dir: Output directory to store extracted files
+   - pre: Filename prefix; optional
+   - suf : Filename suffix; optional
+   - max_workers: Number of files to download concurrently; optional
+   '''
+   os.makedirs(extract_dir, exist_ok=True)
+
+   # Create and open a log file.
+   # If this log file already exists, it will be overwritten.  If it does not exist, it will be created.
+   ProcLogFile = os.path.join(extract_dir, 'README.txt')
+   Log = open(ProcLogFile, 'w+')
+   timestamp = datetime.now().isoformat(sep=' ', timespec='seconds')
+   Log.write("Process logging started %s \n" % timestamp)
+
+   # Make a list of the files to download, from the input table
+   try:
+      with arcpy.da.SearchCursor(in_tab, [in_fld]) as sc:
+         fileList = [pre + row[0] + suf for row in sc]
+   except:
+      printErr('Unable to parse input table.  Exiting...')
+      Log.write('Unable to parse input table.  Exiting...')
+      quit()
+
+   # Download and extract the files, while keeping track of success/failure. Files are downloaded concurrently, but
+   # extracted one at a time, since zip files can contain the same paths (e.g. the INFO folder of ArcInfo grids).
+   session = MakeSession(max_workers)
+   lock = threading.Lock()
+   with ThreadPoolExecutor(max_workers=max_workers) as ex:
+      procList = list(ex.map(lambda f: DownloadExtractFile(session, url, extract_dir, f, lock=lock), fileList))
+   session.close()
 
    # Write download results to log.
-   for item in procList:
-      Log.write("%s\n" % item)
+   Log.write(''.join("%s\n" % item for item in procList))
 
-   timestamp = datetime.now().strftime(FORMAT)
+   timestamp = datetime.now().isoformat(sep=' ', timespec='seconds')
    Log.write("\nProcess logging ended %s" % timestamp)
    Log.close()
 
@@ -108,60 +254,110 @@ def BatchStripName(in_dir, pre='', suf=''):
    - pre: The prefix to strip from file names
    - suf: The suffix to strip from file names
    '''
-   for fileName in os.listdir(in_dir):
-      oldName = in_dir + os.sep + fileName
-      newName = oldName.replace(pre, '')
-      newName = newName.replace(suf, '')
-      if oldName != newName:
-         if os.path.exists(newName):
-            printWrng('This file already exists: %s' % os.path.basename(newName))
+   with os.scandir(in_dir) as it:
+      fileNames = [e.name for e in it]
+   # Set of existing names, used instead of checking the file system for each renamed file
+   existing = set(fileNames)
+   for fileName in fileNames:
+      newFileName = fileName.replace(pre, '')
+      newFileName = newFileName.replace(suf, '')
+      if fileName != newFileName:
+         if newFileName in existing:
+            printWrng('This file already exists: %s' % newFileName)
          else:
-            os.rename(oldName, newName)
-            printMsg('%s renamed to %s.' % (os.path.basename(oldName), os.path.basename(newName)))
+            os.rename(os.path.join(in_dir, fileName), os.path.join(in_dir, newFileName))
+            existing.discard(fileName)
+            existing.add(newFileName)
+            printMsg('%s renamed to %s.' % (fileName, newFileName))
    return
 
 
-def BatchExtractZips(ZipDir, OutDir):
+def ExtractZip(zpath, OutDir, shared=(), sharedOnly=False):
+   '''Extracts a single zip file. Used as the worker function in BatchExtractZips. Returns a tuple of
+   (zip file name, status, error info), where status is one of 'extracted', 'failed', or 'invalid'.
+   Parameters:
+   - zpath: Path to the zip file to be extracted
+   - OutDir: The directory in which extracted files will be stored
+   - shared: Top-level folder or file names which are also in other zip files. Members under these are skipped,
+      unless sharedOnly is True.
+   - sharedOnly: Whether to extract only the members under the shared names (True), or all others (False)
+   '''
+   zfile = os.path.basename(zpath)
+   if not zipfile.is_zipfile(zpath):
+      return (zfile, 'invalid', None)
+   try:
+      with IsalZip(), zipfile.ZipFile(zpath) as zf:
+         zf.extractall(OutDir, [m for m in zf.namelist() if (m.split('/')[0] in shared) == sharedOnly])
+      return (zfile, 'extracted', None)
+   except:
+      tb = sys.exc_info()[2]
+      tbinfo = traceback.format_tb(tb)[0]
+      pymsg = "PYTHON ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n " + str(sys.exc_info()[1])
+      return (zfile, 'failed', pymsg)
+
+
+def SharedZipNames(zpaths):
+   '''Returns the set of top-level folder or file names (e.g. the INFO folder of ArcInfo grids) found in more than one
+   of a list of zip files. Invalid zip files are ignored.
+   Parameters:
+   - zpaths: List of paths to zip files
+   '''
+   counts = {}
+   for zpath in zpaths:
+      try:
+         with zipfile.ZipFile(zpath) as zf:
+            for t in set(m.split('/')[0] for m in zf.namelist()):
+               counts[t] = counts.get(t, 0) + 1
+      except (zipfile.BadZipFile, OSError):
+         pass
+   return set(t for t, n in counts.items() if n > 1)
+
+
+def BatchExtractZips(ZipDir, OutDir, max_workers=None):
    '''Extracts all zip files within a specified directory, and saves the output to another specified directory.
+   Zip files are extracted in parallel, using separate processes. Paths found in more than one zip file are then
+   extracted one zip file at a time, in list order, so later zip files overwrite earlier ones.
    Parameters:
    - ZipDir:  The directory containing the zip files to be extracted
    - OutDir:  The directory in which extracted files will be stored
+   - max_workers: Number of zip files to extract concurrently. If None, uses the number of processors.
    '''
    # If the output directory does not already exist, create it
-   if not os.path.exists(OutDir):
-      os.makedirs(OutDir)
+   os.makedirs(OutDir, exist_ok=True)
 
    # Set up the processing log                                   
-   ProcLog = OutDir + os.sep + "ZipLog.txt"
-   log = open(ProcLog, 'w+')
+   ProcLog = os.path.join(OutDir, "ZipLog.txt")
+   log = open(ProcLog, 'w+', buffering=1 << 16)
 
    try:
       flist = os.listdir(ZipDir)  # Get a list of all items in the input directory
-      zfiles = [f for f in flist if '.zip' in f]  # This limits the list to zip files
-      for zfile in zfiles:
-         if zipfile.is_zipfile(ZipDir + os.sep + zfile):
-            printMsg('Extracting %s' % zfile)
-            try:
-               zf = zipfile.ZipFile(ZipDir + os.sep + zfile)
-               zf.extractall(OutDir)
-               printMsg(zfile + ' extracted')
-               log.write('\n' + zfile + ' extracted')
-
-            except:
+      zfiles = [f for f in flist if f.endswith('.zip')]  # This limits the list to zip files
+      zpaths = [os.path.join(ZipDir, zfile) for zfile in zfiles]
+      # Members under shared names are not extracted in parallel, so that no two processes write the same file
+      shared = SharedZipNames(zpaths)
+      printMsg('Extracting %s zip files...' % len(zfiles))
+      extracted = []
+      with ProcessPoolExecutor(max_workers=max_workers) as ex:
+         for zpath, (zfile, status, pymsg) in zip(zpaths, ex.map(ExtractZip, zpaths, [OutDir] * len(zpaths),
+                                                                 [shared] * len(zpaths))):
+            if status == 'extracted':
+               extracted.append(zpath)
+            elif status == 'failed':
                printMsg('Failed to extract %s' % zfile)
                log.write('\nWarning: Failed to extract %s' % zfile)
-               # Error handling code swiped from "A Python Primer for ArcGIS"
-               tb = sys.exc_info()[2]
-               tbinfo = traceback.format_tb(tb)[0]
-               pymsg = "PYTHON ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n " + str(sys.exc_info()[1])
-               msgs = "ARCPY ERRORS:\n" + arcpy.GetMessages(2) + "\n"
-
-               printWrng(msgs)
                printWrng(pymsg)
-               printWrng(arcpy.GetMessages(1))
+            else:
+               printWrng('%s is not a valid zip file' % zfile)
+               log.write('\nWarning: %s is not a valid zip file' % zfile)
+      for zpath in extracted:
+         zfile, status, pymsg = ExtractZip(zpath, OutDir, shared, sharedOnly=True)
+         if status == 'extracted':
+            printMsg(zfile + ' extracted')
+            log.write('\n' + zfile + ' extracted')
          else:
-            printWrng('%s is not a valid zip file' % zfile)
-            log.write('\nWarning: %s is not a valid zip file' % zfile)
+            printMsg('Failed to extract %s' % zfile)
+            log.write('\nWarning: Failed to extract %s' % zfile)
+            printWrng(pymsg)
       arcpy.AddMessage('Your files have been extracted to %s.' % OutDir)
 
    except:
@@ -198,14 +394,132 @@ def MosaicDEM(in_dir, outRaster):
    return
 
 
-def DEM2FGDB(in_dir, out_gdb):
+def MosaicDEM_VRT(in_dir, outVRT, outRaster=None):
+   '''Mosaics multiple DEM files into a GDAL virtual raster (VRT), which references the source grids instead of
+   copying their pixels. This is much faster than MosaicDEM, and the VRT can be used directly as an input raster. If
+   outRaster is given, the VRT is also written to a tiled, compressed GeoTIFF with overviews. Requires GDAL (osgeo).
+   Assumes they are in ArcGRID format as downloaded and extracted from the 3DEP data.
+   NOTE: Where grids overlap, the VRT uses values from the last grid in the list, rather than the MEAN used in
+   MosaicDEM. Adjacent 3DEP tiles have identical values in overlapping cells, so this should not affect outputs.
+   Parameters:
+   - in_dir: directory containing extracted grids
+   - outVRT: output virtual raster file. Should end in .vrt.
+   - outRaster: (optional) output GeoTIFF file. Should end in .tif.
+   '''
+   from osgeo import gdal
+   gdal.UseExceptions()
+
+   arcpy.env.workspace = in_dir
+   rasterList = [os.path.join(in_dir, r) for r in arcpy.ListRasters('', 'GRID')]
+
+   printMsg('Building virtual mosaic...')
+   vrt = gdal.BuildVRT(outVRT, rasterList, outputType=gdal.GDT_Float32)
+   vrt = None  # Closing the dataset writes the VRT to disk
+
+   if outRaster:
+      printMsg('Writing mosaic to GeoTIFF. This will take awhile...')
+      topts = gdal.TranslateOptions(format='GTiff', creationOptions=['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER'])
+      ds = gdal.Translate(outRaster, outVRT, options=topts)
+      printMsg('Building pyramids. This will take awhile...')
+      ds.BuildOverviews('AVERAGE', [2, 4, 8, 16, 32, 64])
+      ds = None
+      return outRaster
+
+   return outVRT
+
+
+def CopyDEM(gname, in_dir, out_gdb):
+   '''Copies a single GRID-format DEM into a file geodatabase. Used as the worker function in DEM2FGDB. Returns a
+   tuple of (success, list of processing records).
+   Parameters:
+   - gname: Name of the GRID-format raster
+   - in_dir: Directory containing GRID-format rasters
+   - out_gdb: Geodatabase in which copied rasters will be stored
+   '''
+   myProcList = []
+   try:
+      printMsg('Working on %s...' % gname)
+
+      inNED = os.path.join(in_dir, gname)
+      outNED = os.path.join(out_gdb, gname)
+
+      arcpy.CopyRaster_management(inNED, outNED)
+      printMsg('- Added %s to geodatabase' % gname)
+      myProcList.append('\nAdded %s to geodatabase' % gname)
+      return (True, myProcList)
+
+   except:
+      printMsg('Failed to process %s' % gname)
+      myProcList.append('\nFailed to process %s' % gname)
+      # Error handling code swiped from "A Python Primer for ArcGIS"
+      tb = sys.exc_info()[2]
+      tbinfo = traceback.format_tb(tb)[0]
+      pymsg = "PYTHON ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n " + str(sys.exc_info()[1])
+      msgs = "ARCPY ERRORS:\n" + arcpy.GetMessages(2) + "\n"
+
+      printWrng(msgs)
+      printWrng(pymsg)
+      printMsg(arcpy.GetMessages(1))
+
+   return (False, myProcList)
+
+
+def CleanupDEM(gname, in_dir, dfiles):
+   '''Deletes the source data and ancillary files for a GRID-format DEM, after it has been copied to the geodatabase.
+   Deleting a grid also updates the INFO folder shared by all grids in the directory, so this is run for one raster
+   at a time, when no other grids are being read. Returns a list of processing records.
+   Parameters:
+   - gname: Name of the GRID-format raster
+   - in_dir: Directory containing GRID-format rasters
+   - dfiles: List of ancillary files to delete
+   '''
+   myProcList = []
+   inNED = os.path.join(in_dir, gname)
+
+   # Delete the source data
+   try:
+      printMsg('- Deleting source NED for %s' % gname)
+      arcpy.Delete_management(inNED)
+   except:
+      printMsg('Unable to delete source NED for %s' % gname)
+      myProcList.append('Unable to delete source NED for %s' % gname)
+
+   # Delete the remaining files related to the file just copied. Some may already have been removed along with
+   # the source data, and are skipped.
+   printMsg('Files to delete: %s' % dfiles)
+   delfails = 0
+   for d in dfiles:
+      try:
+         if os.path.isdir(d):
+            shutil.rmtree(d)
+         else:
+            os.remove(d)
+      except FileNotFoundError:
+         pass
+      except OSError:
+         delfails += 1
+   if delfails == 0:
+      printMsg('Successfully cleaned up ancillary files for %s' % gname)
+      myProcList.append('Successfully cleaned up ancillary files for %s' % gname)
+   else:
+      printMsg('Unable to delete all ancillary files for %s' % gname)
+      myProcList.append('Unable to delete all ancillary files for %s' % gname)
+
+   return myProcList
+
+
+def DEM2FGDB(in_dir, out_gdb, max_workers=None):
    '''Imports GRID-format DEMs into a file geodatabase, in preparation for adding them to a mosaic dataset. Deletes the source data after successful import of each raster, and writes processing results to a log file.
+   Rasters are copied in parallel, using separate processes; source data are deleted one raster at a time, after
+   all copies have finished.
    Parameters:
    - in_dir: Directory containing GRID-format rasters
    - outGDB: Geodatabase in which copied rasters will be stored
+   - max_workers: Number of rasters to copy concurrently. If None, uses the number of processors, up to 8 (beyond
+      this, file geodatabase lock contention limits any gains).
    '''
 
-   myLogFile = in_dir + os.sep + 'ProcLog.txt'
+   myLogFile = os.path.join(in_dir, 'ProcLog.txt')
 
    arcpy.env.overwriteOutput = True  # Set overwrite option so that existing data may be overwritten
 
@@ -213,66 +527,46 @@ def DEM2FGDB(in_dir, out_gdb):
    arcpy.env.workspace = in_dir
    rasterList = arcpy.ListRasters("*", "GRID")
 
+   # Index the files in the input directory by raster, for cleaning up ancillary files after each raster is copied.
+   # Longer tags are listed first, so they are preferred when one tag contains another. The grid folders themselves
+   # are left out, so they are only ever removed by Delete_management.
+   nedTags = sorted(set(gname[3:] for gname in rasterList), key=len, reverse=True)
+   tag_index = {nedTag: [] for nedTag in nedTags}
+   gridNames = set(gname.lower() for gname in rasterList)
+   if nedTags:
+      pattern = re.compile('(' + '|'.join(re.escape(t) for t in nedTags) + ')')
+      with os.scandir(in_dir) as it:
+         for entry in it:
+            if entry.name.lower() in gridNames:
+               continue
+            m = pattern.search(entry.name)
+            if m:
+               tag_index[m.group(1)].append(entry.path)
+
    # Initialize a list for processing records
    myProcList = []
 
-   for gname in rasterList:
-      try:
-         printMsg('Working on %s...' % gname)
-
-         inNED = in_dir + os.sep + gname
-         outNED = out_gdb + os.sep + gname
-         nedTag = gname[3:]
-
-         arcpy.CopyRaster_management(inNED, outNED)
-         printMsg('- Added %s to geodatabase' % gname)
-         myProcList.append('\nAdded %s to geodatabase' % gname)
-
-         # Delete the source data
-         try:
-            printMsg('- Deleting source NED for %s' % gname)
-            arcpy.Delete_management(inNED)
-         except:
-            printMsg('Unable to delete source NED for %s' % gname)
-            myProcList.append('Unable to delete source NED for %s' % gname)
-
-         # Get the list of files remaining, related to the file just copied
-         flist = os.listdir(in_dir)  # Get a list of all items in the input directory
-         dfiles = [in_dir + os.sep + f for f in flist if nedTag in f]
-         printMsg('Files to delete: %s' % dfiles)
-         delfails = 0
-         for d in dfiles:
-            try:
-               os.remove(d)
-            except:
-               delfails += 1
-         if delfails == 0:
-            printMsg('Successfully cleaned up ancillary files for %s' % gname)
-            myProcList.append('Successfully cleaned up ancillary files for %s' % gname)
-         else:
-            printMsg('Unable to delete all ancillary files for %s' % gname)
-            myProcList.append('Unable to delete all ancillary files for %s' % gname)
-
-      except:
-         printMsg('Failed to process %s' % gname)
-         myProcList.append('\nFailed to process %s' % gname)
-         # Error handling code swiped from "A Python Primer for ArcGIS"
-         tb = sys.exc_info()[2]
-         tbinfo = traceback.format_tb(tb)[0]
-         pymsg = "PYTHON ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n " + str(sys.exc_info()[1])
-         msgs = "ARCPY ERRORS:\n" + arcpy.GetMessages(2) + "\n"
-
-         printWrng(msgs)
-         printWrng(pymsg)
-         printMsg(arcpy.GetMessages(1))
+   if max_workers is None:
+      max_workers = min(8, os.cpu_count())
+   # Rasters are copied in worker processes. Deleting a grid rewrites the INFO folder the other grids are read from,
+   # so source data are only deleted once all copies have finished, one raster at a time.
+   copiedList = []
+   with ProcessPoolExecutor(max_workers=max_workers) as ex:
+      futures = {ex.submit(CopyDEM, gname, in_dir, out_gdb): gname for gname in rasterList}
+      for f in as_completed(futures):
+         copied, procList = f.result()
+         myProcList.extend(procList)
+         if copied:
+            copiedList.append(futures[f])
+   for gname in copiedList:
+      myProcList.extend(CleanupDEM(gname, in_dir, tag_index[gname[3:]]))
 
    # Write processing results to a log file.
    # If this log file already exists, it will be overwritten.  If it does not exist, it will be created.
    Log = open(myLogFile, 'w+')
-   timeStamp = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
+   timeStamp = datetime.now().isoformat(sep=' ', timespec='seconds')
    Log.write('NED processing completed %s.  Results below.\n' % timeStamp)
-   for item in myProcList:
-      Log.write("%s\n" % item)
+   Log.write(''.join("%s\n" % item for item in myProcList))
    Log.close()
    printMsg('Processing results can be viewed in %s' % myLogFile)
 
@@ -304,7 +598,9 @@ def main():
    ### Specify function(s) to run below
    # BatchDownload(in_tab, in_fld, url, out_dir, pre1, suf1) # This should get most files
    # BatchDownload(in_tab, in_fld, url, out_dir, pre2, suf2) # This should hopefully get all remaining
+   # BatchDownloadExtract(in_tab, in_fld, url, in_dir, pre1, suf1) # Alternative to download+extract, without keeping zips
    # BatchStripName(in_dir, pre3, suf3)
+   # MosaicDEM_VRT(in_dir, r'D:\Backups\GIS_Data_VA\3DEP\elev_13Arc.vrt') # Alternative to MosaicDEM/DEM2FGDB
    DEM2FGDB(in_dir, out_gdb)
 
 
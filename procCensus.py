@@ -23,6 +23,132 @@ TODO: Linear blocks around roads are not meeting shape index criteria in many ca
  2010 vs 2000 using original method, so maybe this isn't a big issue.
 """
 from Helper import *
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Use all available cores for tools that support parallel processing (e.g. PolygonToRaster, PairwiseDissolve,
+# EucDistance). Some tools only run in parallel on large inputs, or when the factor is set explicitly.
+arcpy.env.parallelProcessingFactor = "100%"
+
+# Census field names which differ by year: the block population count, and the fields concatenated to make a unique
+# tract ID
+yearFields = {2000: {'POP': 'FXS001', 'TRACT_ID': ['FIPSSTCO', 'TRACT2000']},
+              2010: {'POP': 'H7V001', 'TRACT_ID': ['STATEFP10', 'COUNTYFP10', 'TRACTCE10']}}
+
+
+def ImpervHistogram(zones, imp):
+   '''Counts impervious values (0-100) within each zone, for one tile of aligned zone and impervious arrays.
+
+   Parameters:
+   - zones: Array of zone IDs, with 0 indicating no zone
+   - imp: Array of impervious values, with the same shape as zones
+
+   Returns a tuple of (zone IDs, histogram), where the histogram has one row per zone ID and one column per
+   impervious value.
+   '''
+   valid = (zones > 0) & (imp <= 100)
+   z = zones[valid]
+   v = imp[valid].astype('int64')
+   del valid
+   oids, zi = numpy.unique(z, return_inverse=True)
+   hist = numpy.bincount(zi * 101 + v, minlength=len(oids) * 101).reshape(len(oids), 101).astype('uint32')
+   return oids, hist
+
+
+def ImpervTileHistogram(zoneRast, in_Imperv, xmin, ymin, ncols, nrows):
+   '''Reads one tile of the zone and impervious rasters, and counts impervious values within each zone. Used as the
+   worker function in ImpervZonalStats.
+
+   Parameters:
+   - zoneRast: Zone raster, aligned with in_Imperv
+   - in_Imperv: Input raster representing percent imperviousness
+   - xmin, ymin: Lower left corner of the tile
+   - ncols, nrows: Number of columns and rows in the tile
+
+   Returns a tuple of (zone IDs, histogram), as ImpervHistogram.
+   '''
+   llc = arcpy.Point(xmin, ymin)
+   zones = arcpy.RasterToNumPyArray(zoneRast, llc, ncols, nrows, nodata_to_value=0)
+   imp = arcpy.RasterToNumPyArray(in_Imperv, llc, ncols, nrows, nodata_to_value=255)
+   return ImpervHistogram(zones, imp)
+
+
+def ImpervZonalStats(in_Blocks, in_Imperv, tileRows=256, max_workers=None):
+   '''Calculates imperviousness statistics for census blocks, in a single pass over the impervious raster. Blocks are
+   converted to a zone raster aligned with in_Imperv (assigning cells by cell center, as ZonalStatisticsAsTable
+   does), and all statistics are derived from a histogram of impervious values in each block.
+
+   Only the window of in_Imperv covered by the blocks is read, in tiles of rows which are processed in parallel. Each
+   worker needs roughly 50 bytes per tile cell (the histogram uses several 64-bit copies of the tile), so peak memory
+   is about 50 * tileRows * (columns in the window) * max_workers bytes. For blocks covering Virginia plus 70 miles
+   at 30 m (about 33,000 columns), the default of 256 rows uses about 0.4 GB per worker.
+
+   Only cells with values 0-100 are used. NLCD Impervious rasters use 127 as a NoData value, and this may not be
+   flagged as NoData in the raster itself.
+
+   Parameters:
+   - in_Blocks: Input feature class representing Census blocks
+   - in_Imperv: Input raster representing percent imperviousness
+   - tileRows: Number of raster rows to read at a time, in each worker
+   - max_workers: Number of worker processes used to process tiles (default: the number of CPUs, up to 8)
+
+   Returns a NumPy structured array with the fields BLOCK_OID (ObjectID of the block), IMPERV_MEAN, IMPERV_MEDIAN, and
+   IMPERV20_MEAN (proportion of cells with 20% or greater imperviousness), sorted by BLOCK_OID. Blocks without any
+   cells (i.e. too small to contain a cell center) are not included.
+   '''
+   scratchGDB = arcpy.env.scratchGDB
+   zoneRast = scratchGDB + os.sep + 'tmp_blockZones'
+
+   printMsg('Converting blocks to zone raster...')
+   oidFld = arcpy.Describe(in_Blocks).OIDFieldName
+   with arcpy.EnvManager(extent=in_Blocks, cellSize=in_Imperv, snapRaster=in_Imperv,
+                         outputCoordinateSystem=in_Imperv):
+      arcpy.PolygonToRaster_conversion(in_Blocks, oidFld, zoneRast, 'CELL_CENTER')
+
+   # Histogram of impervious values (0-100) for each block, reading the impervious raster for the same cells as the
+   # zone raster, in tiles processed by a pool of worker processes
+   printMsg('Summarizing imperviousness by block...')
+   zr = arcpy.Raster(zoneRast)
+   xmin, ymax, ncols, cellHeight = zr.extent.XMin, zr.extent.YMax, zr.width, zr.meanCellHeight
+   tiles = [(r0, min(tileRows, zr.height - r0)) for r0 in range(0, zr.height, tileRows)]
+   del zr
+   if max_workers is None:
+      max_workers = min(8, os.cpu_count())
+   with ProcessPoolExecutor(max_workers=max_workers) as ex:
+      futures = [ex.submit(ImpervTileHistogram, zoneRast, in_Imperv, xmin, ymax - (r0 + nrows) * cellHeight, ncols,
+                           nrows) for r0, nrows in tiles]
+      results = [f.result() for f in futures]
+   arcpy.Delete_management(zoneRast)
+
+   # Combine histograms for blocks spanning more than one tile
+   oids = numpy.concatenate([r[0] for r in results])
+   hist = numpy.concatenate([r[1] for r in results])
+   del results
+   order = numpy.argsort(oids, kind='stable')
+   oids = oids[order]
+   starts = numpy.flatnonzero(numpy.r_[True, oids[1:] != oids[:-1]])
+   hist = numpy.add.reduceat(hist[order], starts, axis=0)
+   oids = oids[starts]
+   del order, starts
+
+   # Derive statistics from the histogram
+   vals = numpy.arange(101)
+   count = hist.sum(axis=1)
+   mean = (hist * vals).sum(axis=1) / count
+   mean20 = hist[:, 20:].sum(axis=1) / count
+   # Median is the average of the lower and upper middle values
+   cum = hist.cumsum(axis=1)
+   lo = (cum < ((count + 1) // 2)[:, None]).sum(axis=1)
+   hi = (cum < (count // 2 + 1)[:, None]).sum(axis=1)
+   median = (lo + hi) / 2
+
+   out = numpy.empty(len(oids), dtype=[('BLOCK_OID', 'i4'), ('IMPERV_MEAN', 'f8'), ('IMPERV_MEDIAN', 'f8'),
+                                       ('IMPERV20_MEAN', 'f8')])
+   out['BLOCK_OID'] = oids
+   out['IMPERV_MEAN'] = mean
+   out['IMPERV_MEDIAN'] = median
+   out['IMPERV20_MEAN'] = mean20
+   return out
 
 
 def PrepBlocks(in_Blocks, in_PopTab, in_Imperv, in_Year, out_Tracts=None):
@@ -45,93 +171,90 @@ def PrepBlocks(in_Blocks, in_PopTab, in_Imperv, in_Year, out_Tracts=None):
    - in_Imperv: Input raster representing percent imperviousness
    - in_Year: The census year of the data
    - out_Tracts: (optional) Output feature class representing Census tracts
-   - REMOVED (now generated in-function): in_Imperv20: Input raster in which cells with 20% or greater imperviousness are set to 1, otherwise 0
    '''
-   scratchGDB = arcpy.env.scratchGDB
-
    # Existing field names in blocks feature class
-   bnames = [f.name for f in arcpy.ListFields(in_Blocks)]
-
-   # Change the relevant field name to POP, if not already done
-   if len(arcpy.ListFields(in_PopTab, "POP")) < 1:
-      printMsg('Renaming field to POP...')
-      if in_Year == 2000:
-         arcpy.AlterField_management(in_PopTab, 'FXS001', 'POP', 'POP')
-      elif in_Year == 2010:
-         # arcpy.AlterField_management (in_PopTab, 'H7V001', 'POP', 'POP')
-         # DB Note: Had issues with the subsequent join, when using AlterField. Calculating new field instead
-         arcpy.AddField_management(in_PopTab, 'POP', 'LONG')
-         arcpy.CalculateField_management(in_PopTab, 'POP', '!H7V001!', 'PYTHON')
+   bnames = {f.name for f in arcpy.ListFields(in_Blocks)}
+
+   # Determine the fields to add. New fields are calculated in memory from a single read of the blocks, then added to
+   # the blocks with a single ExtendTable call.
+   impFlds = [f for f in ['IMPERV_MEAN', 'IMPERV_MEDIAN', 'IMPERV20_MEAN'] if f not in bnames]
+   newFlds = [f for f in ['POP', 'AREA_SQMI', 'DENS_PPSM', 'SHP_IDX'] if f not in bnames] + impFlds
+   if out_Tracts and 'TRACT_ID' not in bnames:
+      newFlds.append('TRACT_ID')
+   if ('POP' in newFlds or 'TRACT_ID' in newFlds) and in_Year not in yearFields:
+      printErr('Not a valid year.')
+      return
+   if 'POP' in newFlds:
+      if "POP" in {f.name for f in arcpy.ListFields(in_PopTab) if not f.required}:
+         popFld = 'POP'
       else:
-         printErr('Not a valid year.')
-
-   # Join fields from the population table to the feature class
-   fnames = [f.name for f in arcpy.ListFields(in_PopTab)]
-   fnames.remove('GISJOIN')
-   fnames.remove('OBJECTID')
-   if 'POP' not in bnames:
-      printMsg('Joining fields...')
-      # arcpy.JoinField_management (in_Blocks, 'GISJOIN', in_PopTab, 'GISJOIN', fnames)
-      arcpy.JoinField_management(in_Blocks, 'GISJOIN', in_PopTab, 'GISJOIN', 'POP')
-
-   # Get a unique tract ID
-   # printMsg('Creating and calculating TRACT_ID field...')
-   # arcpy.AddField_management(in_Blocks, "TRACT_ID", "TEXT", "", "", 11)
-   # if in_Year == 2000:
-   #    expression = "!FIPSSTCO!+ !TRACT2000!"
-   # elif in_Year == 2010:
-   #    expression = "!STATEFP10!+ !COUNTYFP10! + !TRACTCE10!"
-   # else:
-   #    printErr('Not a valid year.')
-   # arcpy.CalculateField_management(in_Blocks, "TRACT_ID", expression, "PYTHON_9.3")
-
-   # Calculate the area in square miles, and change the output field name.
-   if 'AREA_SQMI' not in bnames:
-      printMsg('Calculating area...')
-      arcpy.AddGeometryAttributes_management(in_Blocks, "AREA", "", "SQUARE_MILES_US")
-      arcpy.AlterField_management(in_Blocks, 'POLY_AREA', 'AREA_SQMI', 'AREA_SQMI')
-
-   # Calculate the population density in persons per square mile
-   if 'DENS_PPSM' not in bnames:
-      printMsg('Calculating population density...')
-      arcpy.AddField_management(in_Blocks, "DENS_PPSM", "DOUBLE")
-      expression = "!POP! / !AREA_SQMI!"
-      arcpy.CalculateField_management(in_Blocks, "DENS_PPSM", expression, "PYTHON_9.3")
-
-   # Calculate the shape index
-   if 'SHP_IDX' not in bnames:
-      printMsg('Calculating shape index...')
-      arcpy.AddField_management(in_Blocks, "SHP_IDX", "DOUBLE")
-      expression = "(4*math.pi* !Shape_Area!)/(!Shape_Length!**2)"
-      arcpy.CalculateField_management(in_Blocks, "SHP_IDX", expression, "PYTHON_9.3")
-
-   # Calculate the imperviousness
-   if 'IMPERV_MEAN' not in bnames:
-      printMsg('Calculating imperviousness...')
-      zTab = in_Blocks + '_Imperv'
-      ZonalStatisticsAsTable(in_Blocks, 'GISJOIN', in_Imperv, zTab, "DATA", "ALL")
-      arcpy.JoinField_management(in_Blocks, 'GISJOIN', zTab, 'GISJOIN', ['MEAN', 'MEDIAN'])
-      arcpy.AlterField_management(in_Blocks, 'MEAN', 'IMPERV_MEAN')
-      arcpy.AlterField_management(in_Blocks, 'MEDIAN', 'IMPERV_MEDIAN')
-
-   # Calculate the proportion of polygon covered by 20% or greater imperviousness
-   if 'IMPERV20_MEAN' not in bnames:
-      printMsg('Calculating proportion with 20% or greater imperviousness...')
-      in_Imperv20 = scratchGDB + os.sep + 'tmp_imp20'
-      # NLCD Impervious rasters use 127 as a NoData value, which is why 'Value <= 100' is included below.
-      with arcpy.EnvManager(extent=in_Blocks, cellSize=in_Imperv, snapRaster=in_Imperv,
-                            outputCoordinateSystem=in_Imperv):
-         arcpy.sa.Con(in_Imperv, 1, 0, 'Value >= 20 AND Value <= 100').save(in_Imperv20)
-      zTab20 = in_Blocks + '_Imperv20'
-      ZonalStatisticsAsTable(in_Blocks, 'GISJOIN', in_Imperv20, zTab20, "DATA", "MEAN")
-      arcpy.JoinField_management(in_Blocks, 'GISJOIN', zTab20, 'GISJOIN', ['MEAN'])
-      arcpy.AlterField_management(in_Blocks, 'MEAN', 'IMPERV20_MEAN')
+         popFld = yearFields[in_Year]['POP']
+   tractFlds = yearFields[in_Year]['TRACT_ID'] if 'TRACT_ID' in newFlds else []
+
+   if len(newFlds) > 0:
+      desc = arcpy.Describe(in_Blocks)
+      inFlds = ['OID@', 'GISJOIN', 'SHAPE@AREA', 'SHAPE@LENGTH'] + tractFlds
+      if 'POP' in bnames:
+         inFlds.append('POP')
+      arr = arcpy.da.FeatureClassToNumPyArray(in_Blocks, inFlds, null_value={'POP': 0} if 'POP' in bnames else None)
+      newVals = {}
+
+      # Join population from the population table, as a new field named POP
+      if 'POP' in newFlds:
+         printMsg('Joining population field...')
+         popArr = arcpy.da.TableToNumPyArray(in_PopTab, ['GISJOIN', popFld], null_value={popFld: 0})
+         popArr.sort(order='GISJOIN')
+         idx = numpy.searchsorted(popArr['GISJOIN'], arr['GISJOIN']).clip(0, len(popArr) - 1)
+         match = popArr['GISJOIN'][idx] == arr['GISJOIN']
+         newVals['POP'] = numpy.where(match, popArr[popFld][idx], 0)
+         pop = newVals['POP']
+         del popArr
+      else:
+         pop = arr['POP']
+
+      # Calculate the area in square miles, the population density in persons per square mile, and the shape index.
+      # Area is converted from the units of the coordinate system to U.S. survey square miles.
+      printMsg('Calculating area, population density, and shape index...')
+      area = arr['SHAPE@AREA'] * desc.spatialReference.metersPerUnit ** 2 / 2589998.470319521
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+         newVals['AREA_SQMI'] = area
+         newVals['DENS_PPSM'] = numpy.where(area > 0, pop / area, 0)
+         newVals['SHP_IDX'] = (4 * numpy.pi * arr['SHAPE@AREA']) / (arr['SHAPE@LENGTH'] ** 2)
+
+      # Get a unique tract ID
+      if tractFlds:
+         tractID = arr[tractFlds[0]]
+         for f in tractFlds[1:]:
+            tractID = numpy.char.add(tractID, arr[f])
+         newVals['TRACT_ID'] = tractID
+
+      # Calculate the imperviousness (mean and median), and the proportion of polygon covered by 20% or greater
+      # imperviousness. All three are calculated from a single pass over the impervious raster. Blocks containing no
+      # cell centers are left null.
+      if len(impFlds) > 0:
+         printMsg('Calculating imperviousness...')
+         zStats = ImpervZonalStats(in_Blocks, in_Imperv)
+         idx = numpy.searchsorted(zStats['BLOCK_OID'], arr['OID@']).clip(0, len(zStats) - 1)
+         match = zStats['BLOCK_OID'][idx] == arr['OID@']
+         for f in impFlds:
+            newVals[f] = numpy.where(match, zStats[f][idx], numpy.nan)
+         del zStats
+
+      printMsg('Adding fields %s...' % ', '.join(newFlds))
+      dtypes = {'POP': '<i4', 'TRACT_ID': '<U11'}
+      newArr = numpy.empty(len(arr), [('BLOCK_OID', '<i4')] + [(f, dtypes.get(f, '<f8')) for f in newFlds])
+      newArr['BLOCK_OID'] = arr['OID@']
+      for f in newFlds:
+         newArr[f] = newVals[f]
+      arcpy.da.ExtendTable(in_Blocks, desc.OIDFieldName, newArr, 'BLOCK_OID')
+      del arr, newArr
 
    # Dissolve blocks to get tracts. Aggregate to get sums of population and area.
    # Keep multi-parts, because some tracts get split by water but should be counted as a single unit
+   # Pairwise Dissolve processes each TRACT_ID group independently, rather than overlaying all blocks at once.
    if out_Tracts:
       printMsg('Dissolving blocks to create tracts...')
-      arcpy.Dissolve_management(in_Blocks, out_Tracts, "TRACT_ID", "POP SUM;AREA_SQMI SUM", "MULTI_PART")
+      arcpy.PairwiseDissolve_analysis(in_Blocks, out_Tracts, "TRACT_ID", "POP SUM;AREA_SQMI SUM", "MULTI_PART")
       arcpy.AlterField_management(out_Tracts, "SUM_POP", "POP")
       arcpy.AlterField_management(out_Tracts, "SUM_AREA_SQMI", "AREA_SQMI")
 
@@ -147,6 +270,45 @@ def PrepBlocks(in_Blocks, in_PopTab, in_Imperv, in_Year, out_Tracts=None):
       return in_Blocks
 
 
+def SelectByOID(in_Lyr, oids, chunkSize=1000):
+   '''Selects features in a layer from a list of ObjectIDs. IDs are selected in chunks, to avoid overly long SQL queries.
+
+   Parameters:
+   - in_Lyr: Input feature layer
+   - oids: Collection of ObjectIDs to select
+   - chunkSize: Maximum number of ObjectIDs included in a single query
+   '''
+   oidFld = arcpy.Describe(in_Lyr).OIDFieldName
+   oids = sorted(oids)
+   arcpy.SelectLayerByAttribute_management(in_Lyr, 'CLEAR_SELECTION')
+   for i in range(0, len(oids), chunkSize):
+      where_clause = '%s IN (%s)' % (oidFld, ','.join(str(o) for o in oids[i:i + chunkSize]))
+      arcpy.SelectLayerByAttribute_management(in_Lyr, 'ADD_TO_SELECTION', where_clause)
+   return in_Lyr
+
+
+def BlockNeighbors(in_Blocks):
+   '''Gets pairs of adjacent census blocks (sharing an edge or a node). Adjacency is calculated once for all blocks,
+   and stored in a table alongside the blocks (named in_Blocks + '_Neighbors'), which is reused on later calls. If
+   block geometry is changed, delete this table so it is recalculated.
+
+   Parameters:
+   - in_Blocks: Input feature class representing Census blocks
+
+   Returns a NumPy array with two columns: ObjectIDs of the source and neighboring blocks. Each pair is included in
+   both directions.
+   '''
+   nbrTab = in_Blocks + '_Neighbors'
+   oidFld = arcpy.Describe(in_Blocks).OIDFieldName
+   if arcpy.Exists(nbrTab):
+      printMsg('Using existing block neighbors table...')
+   else:
+      printMsg('Finding neighbors of blocks...')
+      arcpy.PolygonNeighbors_analysis(in_Blocks, nbrTab, oidFld, 'NO_AREA_OVERLAP', 'BOTH_SIDES')
+   nbrs = arcpy.da.TableToNumPyArray(nbrTab, ['src_' + oidFld, 'nbr_' + oidFld])
+   return numpy.column_stack([nbrs['src_' + oidFld], nbrs['nbr_' + oidFld]])
+
+
 def MakeUrbanCores(in_Blocks, out_Cores):
    '''Creates urban cores from input census blocks. Methodology adapted loosely from Section 1 on page 53040 of the
    "Urban Area Criteria for the 2010 Census" (https://www.federalregister.gov/documents/2011/08/24/2011-21647/urban
@@ -156,63 +318,59 @@ def MakeUrbanCores(in_Blocks, out_Cores):
       - in_Blocks: Input feature class representing Census blocks; this should have been updated using the PrepBlocks function
       - out_Cores: Output feature class representing urban cores
    '''
-   scratchGDB = arcpy.env.scratchGDB
-   coreBlocks = scratchGDB + os.sep + 'coreBlocks'
-   expandCores = scratchGDB + os.sep + 'expandCores'
-
-   # Select census blocks with population density at least 1000 ppsm 
+   # Intermediate data are kept in the memory workspace, and deleted when finished
+   scratchWS = 'memory'
+   expandCores = scratchWS + os.sep + 'expandCores'
+   oidFld = arcpy.Describe(in_Blocks).OIDFieldName
+
+   # Read the block attributes used in the core criteria once. Null values (e.g. imperviousness for blocks too small to
+   # contain a cell center) are read as -1, which fails every criterion, as nulls do in a SQL query.
+   printMsg('Reading block attributes...')
+   critFlds = ['DENS_PPSM', 'IMPERV_MEAN', 'IMPERV20_MEAN', 'SHP_IDX']
+   arr = arcpy.da.FeatureClassToNumPyArray(in_Blocks, ['OID@', 'SHAPE@AREA'] + critFlds,
+                                           null_value={f: -1 for f in critFlds})
+
+   # Select census blocks with population density at least 1000 ppsm
    # Later added criterion that size must be not smaller than four 30-m pixels, to avoid spurious cores
-   where_clause = "DENS_PPSM >= 1000 AND Shape_Area >= 3600"
-   printMsg('Selecting high-density blocks to initiate cores...')
-   arcpy.MakeFeatureLayer_management(in_Blocks, 'lyr_PrimaryBlocks', where_clause)
-   arcpy.CopyFeatures_management('lyr_PrimaryBlocks', coreBlocks)
-
-   # Continue to add blocks meeting density and/or imperviousness criteria, that are adjacent to expanding urban cores
-   # t0 = time.time()
-   # arcpy.CopyFeatures_management(coreBlocks, expandCores)
-   # where_clause = "(DENS_PPSM >= 500) OR (IMPERV_MEAN >= 20 AND SHP_IDX >= 0.185) OR (IMPERV20_MEAN >= 0.33 AND SHP_IDX >= 0.185)"
-   # printMsg('Selecting additional adjacent blocks to expand cores...')
-   # arcpy.MakeFeatureLayer_management(in_Blocks, 'lyr_SecondaryBlocks', where_clause)
-   # arcpy.SelectLayerByLocation_management ('lyr_SecondaryBlocks', 'WITHIN_A_DISTANCE', expandCores, '0 METERS', 'NEW_SELECTION')
-   # arcpy.SelectLayerByLocation_management ('lyr_SecondaryBlocks', 'ARE_IDENTICAL_TO', expandCores, '', 'REMOVE_FROM_SELECTION')
-   # c = countSelectedFeatures('lyr_SecondaryBlocks')
-   # while c > 0:
-   #    printMsg('Continuing to expand cores with %s additional blocks...'%str(c))
-   #    arcpy.Append_management ('lyr_SecondaryBlocks', expandCores)
-   #    arcpy.SelectLayerByLocation_management ('lyr_SecondaryBlocks', 'WITHIN_A_DISTANCE', expandCores, '0 METERS', 'NEW_SELECTION')
-   #    arcpy.SelectLayerByLocation_management ('lyr_SecondaryBlocks', 'ARE_IDENTICAL_TO', expandCores, '', 'REMOVE_FROM_SELECTION')
-   #    c = countSelectedFeatures('lyr_SecondaryBlocks')
-   # t1 = time.time()
-   # elapsed_method1 = t1 - t0
-
-   # initiate selection
-   # t0 = time.time()
-   where_clause = "(DENS_PPSM >= 500) OR (IMPERV_MEAN >= 20 AND SHP_IDX >= 0.185) OR (IMPERV20_MEAN >= 0.33 AND SHP_IDX >= 0.185)"
+   primary = (arr['DENS_PPSM'] >= 1000) & (arr['SHAPE@AREA'] >= 3600)
+   seeds = arr['OID@'][primary].tolist()
+
+   # Continue to add blocks meeting density and/or imperviousness criteria, that are adjacent to expanding urban cores.
+   # Cores are expanded by a breadth-first search from the seed blocks, over the adjacency graph of candidate blocks.
+   # Seed blocks always meet the candidate criteria, since DENS_PPSM >= 1000.
    printMsg('Selecting additional adjacent blocks to expand cores...')
-   arcpy.MakeFeatureLayer_management(in_Blocks, 'lyr_SecondaryBlocks', where_clause)
-   arcpy.SelectLayerByLocation_management('lyr_SecondaryBlocks', 'WITHIN_A_DISTANCE', coreBlocks, '0 METERS',
-                                          'NEW_SELECTION')
-   c0 = countFeatures(coreBlocks)
-   c1 = countSelectedFeatures('lyr_SecondaryBlocks')
-   # loop until no new are added
-   while c1 > c0:
-      printMsg('Cores expanding, with %s additional blocks...' % str(c1 - c0))
-      c0 = countSelectedFeatures('lyr_SecondaryBlocks')
-      arcpy.SelectLayerByLocation_management('lyr_SecondaryBlocks', 'WITHIN_A_DISTANCE', 'lyr_SecondaryBlocks',
-                                             '0 METERS', 'ADD_TO_SELECTION')
-      c1 = countSelectedFeatures('lyr_SecondaryBlocks')
+   secondary = ((arr['DENS_PPSM'] >= 500) | ((arr['IMPERV_MEAN'] >= 20) & (arr['SHP_IDX'] >= 0.185)) |
+                ((arr['IMPERV20_MEAN'] >= 0.33) & (arr['SHP_IDX'] >= 0.185)))
+   candOIDs = arr['OID@'][secondary]
+   del arr, primary, secondary
+   nbrs = BlockNeighbors(in_Blocks)
+   keep = numpy.isin(nbrs[:, 0], candOIDs) & numpy.isin(nbrs[:, 1], candOIDs)
+   adj = defaultdict(list)
+   for src, nbr in nbrs[keep].tolist():
+      adj[src].append(nbr)
+   del nbrs, keep, candOIDs
+
+   coreOIDs = set(seeds)
+   queue = deque(seeds)
+   while queue:
+      for nbr in adj[queue.popleft()]:
+         if nbr not in coreOIDs:
+            coreOIDs.add(nbr)
+            queue.append(nbr)
+   printMsg('Cores expanded from %s to %s blocks.' % (str(len(seeds)), str(len(coreOIDs))))
+
+   arcpy.MakeFeatureLayer_management(in_Blocks, 'lyr_SecondaryBlocks')
+   SelectByOID('lyr_SecondaryBlocks', coreOIDs)
    arcpy.CopyFeatures_management('lyr_SecondaryBlocks', expandCores)
    printMsg('Finished expanding cores.')
-   # t1 = time.time()
-   # elapsed_method2 = t1 - t0
 
    # Dissolve cores
-   dissCores = scratchGDB + os.sep + "dissCores"
+   dissCores = scratchWS + os.sep + "dissCores"
    printMsg('Dissolving features...')
-   arcpy.Dissolve_management(expandCores, dissCores, "", "", "MULTI_PART")
+   arcpy.PairwiseDissolve_analysis(expandCores, dissCores, "", "", "MULTI_PART")
 
    # Remove small holes and polygons
-   fillCores = scratchGDB + os.sep + "fillCores"
+   fillCores = scratchWS + os.sep + "fillCores"
    printMsg('Eliminating gaps and runts...')
    arcpy.EliminatePolygonPart_management(dissCores, fillCores, "AREA", "1 SquareMiles", "", "ANY")
    # TODO: Only remove inner holes instead of ANY? With ANY, cores get removed when separated
@@ -220,32 +378,59 @@ def MakeUrbanCores(in_Blocks, out_Cores):
    # arcpy.EliminatePolygonPart_management(dissCores, fillCores, "AREA", "1 SquareMiles")
 
    # Group disjunct but nearby cores
-   buffCores = scratchGDB + os.sep + "buffCores"
-   grpCores = scratchGDB + os.sep + "grpCores"
+   buffCores = scratchWS + os.sep + "buffCores"
+   grpCores = scratchWS + os.sep + "grpCores"
    printMsg('Grouping cores...')
-   arcpy.Buffer_analysis(fillCores, buffCores, "0.25 Miles", "", "", "ALL")
+   arcpy.PairwiseBuffer_analysis(fillCores, buffCores, "0.25 Miles", "ALL")
    arcpy.MultipartToSinglepart_management(buffCores, grpCores)
 
    # Generate CORE_ID field 
    printMsg('Adding CORE_ID field...')
    arcpy.AddField_management(grpCores, "CORE_ID", "LONG")
-   expression = "!OBJECTID!"
-   arcpy.CalculateField_management(grpCores, "CORE_ID", expression, "PYTHON_9.3")
+   with arcpy.da.UpdateCursor(grpCores, ['OID@', 'CORE_ID']) as uc:
+      for row in uc:
+         row[1] = row[0]
+         uc.updateRow(row)
 
    # Attach CORE_ID to relevant blocks
-   tmpBlocks = scratchGDB + os.sep + "tmpBlocks"
+   tmpBlocks = scratchWS + os.sep + "tmpBlocks"
+   # fillCores is a single multipart feature. Test blocks against its individual parts instead, so the spatial index
+   # limits each test to the nearby part, rather than the entire set of cores.
+   fillParts = scratchWS + os.sep + "fillParts"
+   arcpy.MultipartToSinglepart_management(fillCores, fillParts)
    arcpy.MakeFeatureLayer_management(in_Blocks, 'lyr_coreBlocks')
-   arcpy.SelectLayerByLocation_management('lyr_coreBlocks', 'WITHIN', fillCores, '', 'NEW_SELECTION')
+   arcpy.SelectLayerByLocation_management('lyr_coreBlocks', 'WITHIN', fillParts, '', 'NEW_SELECTION')
    printMsg('Performing spatial join...')
-   arcpy.SpatialJoin_analysis('lyr_coreBlocks', grpCores, tmpBlocks, "JOIN_ONE_TO_ONE", "KEEP_COMMON", "", "WITHIN")
+   # Only carry over the fields needed for summarizing cores
+   fldMaps = arcpy.FieldMappings()
+   for src, fld in [('lyr_coreBlocks', 'POP'), ('lyr_coreBlocks', 'AREA_SQMI'), (grpCores, 'CORE_ID')]:
+      fldMap = arcpy.FieldMap()
+      fldMap.addInputField(src, fld)
+      fldMaps.addFieldMap(fldMap)
+   arcpy.SpatialJoin_analysis('lyr_coreBlocks', grpCores, tmpBlocks, "JOIN_ONE_TO_ONE", "KEEP_COMMON", fldMaps, "WITHIN")
+
+   # Core geometry is taken from the filled cores, grouped by CORE_ID, rather than by dissolving the joined blocks
+   printMsg('Creating core polygons...')
+   partCores = scratchWS + os.sep + "partCores"
+   fldMaps = arcpy.FieldMappings()
+   fldMap = arcpy.FieldMap()
+   fldMap.addInputField(grpCores, 'CORE_ID')
+   fldMaps.addFieldMap(fldMap)
+   arcpy.SpatialJoin_analysis(fillParts, grpCores, partCores, "JOIN_ONE_TO_ONE", "KEEP_COMMON", fldMaps, "WITHIN")
+   arcpy.PairwiseDissolve_analysis(partCores, out_Cores, "CORE_ID", "", "MULTI_PART")
 
    # Get population and area for each urban core
    printMsg('Summarizing population and area...')
-   arcpy.Dissolve_management(tmpBlocks, out_Cores, "CORE_ID", "POP SUM;AREA_SQMI SUM", "MULTI_PART")
-   arcpy.AlterField_management(out_Cores, "SUM_POP", "POP")
-   arcpy.AlterField_management(out_Cores, "SUM_AREA_SQMI", "AREA_SQMI")
+   df = pandas.DataFrame(arcpy.da.TableToNumPyArray(tmpBlocks, ['CORE_ID', 'POP', 'AREA_SQMI'], null_value=0))
+   agg = df.groupby('CORE_ID').sum()
+   coreStats = numpy.empty(len(agg), dtype=[('CORE_ID', '<i4'), ('POP', '<i4'), ('AREA_SQMI', '<f8')])
+   coreStats['CORE_ID'] = agg.index
+   coreStats['POP'] = agg['POP']
+   coreStats['AREA_SQMI'] = agg['AREA_SQMI']
+   arcpy.da.ExtendTable(out_Cores, 'CORE_ID', coreStats, 'CORE_ID')
    # TODO: Remove cores < 1 sq mile here? Would be necessary if change is made not to remove these in fillCores.
 
+   arcpy.Delete_management(scratchWS)
    printMsg('Finished making cores.')
    return out_Cores
 
@@ -255,24 +440,18 @@ def CategorizeCores(in_Cores):
    Parameters:
    - in_Cores: the input cores, generated by the MakeUrbanCores function. This will be modified by adding and populating a new field.'''
 
+   # Core types by population: 0 = Excluded Core (< 1000, or < 2500 and smaller than 1 sq mile), 1 = Seed Core,
+   # 2 = Small Town Core, 3 = Small City Core, 4 = Big City Core, 5 = Major Metro Core
+   arr = arcpy.da.FeatureClassToNumPyArray(in_Cores, ['OID@', 'POP', 'AREA_SQMI'], null_value=0)
+   coreType = numpy.digitize(arr['POP'], [1000, 2500, 25000, 250000, 2500000])
+   coreType[(coreType == 1) & (arr['AREA_SQMI'] < 1)] = 0
+   coreTypes = dict(zip(arr['OID@'].tolist(), coreType.tolist()))
+
    arcpy.AddField_management(in_Cores, "CORE_TYPE", "SHORT")
-   codeblock = '''def catCores(pop, area):
-      if pop < 2500:
-         if pop >= 1000 and area >=1:
-            return 1 # Seed Core
-         else:
-            return 0 # Excluded Core
-      elif pop < 25000:
-         return 2 # Small Town Core
-      elif pop < 250000:
-         return 3 # Small City Core
-      elif pop < 2500000:
-         return 4 # Big City Core
-      else:
-         return 5 # Major Metro Core
-   '''
-   expression = "catCores(!POP!, !AREA_SQMI!)"
-   arcpy.CalculateField_management(in_Cores, "CORE_TYPE", expression, "PYTHON_9.3", codeblock)
+   with arcpy.da.UpdateCursor(in_Cores, ['OID@', 'CORE_TYPE']) as uc:
+      for row in uc:
+         row[1] = coreTypes[row[0]]
+         uc.updateRow(row)
    return in_Cores
 
 
@@ -285,7 +464,6 @@ def main():
    # # blocks subset to an additional 20 miles around the processing buffer, i.e., 70 miles around Virginia.
    # in_PopTab = r'C:\Users\xch43889\Documents\Working\ConsVision\VulnMod\CensusWork2000.gdb\CensusBlocks2000_Pop'
    # in_Imperv = r'D:\Backups\GIS_Data_VA\NLCD\Products_2016\NLCD_imperv_20190405\NLCD_2006_Impervious_L48_20190405.img'
-   # # in_Imperv20 = r'C:\Users\xch43889\Documents\Working\ConsVision\VulnMod\vuln_work.gdb\imperv2006_20plus'  # now generated in-function
    # out_Tracts = r'C:\Users\xch43889\Documents\Working\ConsVision\VulnMod\CensusWork2000.gdb\CensusTracts2000_70mi'
    # in_Year = 2000
    # in_Tracts = out_Tracts
@@ -296,7 +474,7 @@ def main():
    # # End of variable input
    #
    # # Specify function(s) to run below
-   # PrepBlocks(in_Blocks, in_PopTab, in_Imperv, in_Year, out_Tracts)   # DB Note: removed in_Imperv20, now generated in-function
+   # PrepBlocks(in_Blocks, in_PopTab, in_Imperv, in_Year, out_Tracts)
    # MakeUrbanCores(in_Blocks, out_Cores3)
    # CategorizeCores(in_Cores)
 
@@ -13,6 +13,7 @@ It also includes development of a euclidean distance to conservation lands predi
 lands outside of VA as well.
 """
 from Helper import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def polyFlatten(inPolys, outPolys, field, values=None, scratchGDB=None):
@@ -39,32 +40,30 @@ def polyFlatten(inPolys, outPolys, field, values=None, scratchGDB=None):
    else:
       printMsg('Using defined sort order from `values`.')
 
-   for val in values:
-      # Make a subset feature layer
-      lyr = "value%s" % val
-      where_clause = field + " = '%s'" % val
-      printMsg('Making feature layer...')
-      arcpy.MakeFeatureLayer_management(inPolys, lyr, where_clause)
-
-      # Dissolve
-      dissFeats = scratchGDB + os.sep + "valueDiss" + str(values.index(val))
-      printMsg('Dissolving...')
-      arcpy.Dissolve_management(lyr, dissFeats, field, "", "SINGLE_PART")
-
-      # Update
-      if values.index(val) == 0:
-         printMsg('Setting initial features to be updated...')
-         inFeats = dissFeats
-      else:
-         printMsg('Updating with value %s...' % val)
-         printMsg('input features: %s' % inFeats)
-         printMsg('update features: %s' % dissFeats)
-         if values.index(val) == len(values)-1:
-            updatedFeats = outPolys
-         else:
-            updatedFeats = scratchGDB + os.sep + "upd_value%s" % str(values.index(val))
-         arcpy.Update_analysis(inFeats, dissFeats, updatedFeats)
-         inFeats = updatedFeats
+   # Split the polygons into non-overlapping pieces, with a table recording which input polygons overlap each piece
+   lyr = 'lyr_flatten'
+   where_clause = field + " IN (%s)" % ', '.join("'%s'" % v for v in values)
+   arcpy.MakeFeatureLayer_management(inPolys, lyr, where_clause)
+   pieces = scratchGDB + os.sep + 'flatPieces'
+   ovTab = scratchGDB + os.sep + 'flatOverlaps'
+   printMsg('Finding overlaps...')
+   arcpy.CountOverlappingFeatures_analysis(lyr, pieces, 1, ovTab)
+
+   # Assign each piece the preferred value among the polygons it is part of
+   printMsg('Assigning preferred values...')
+   rank = {v: i for i, v in enumerate(values)}
+   src = pandas.DataFrame(arcpy.da.TableToNumPyArray(lyr, ['OID@', field]))
+   srcRank = pandas.Series(src[field].astype(str).map(rank).values, index=src['OID@'])
+   ov = pandas.DataFrame(arcpy.da.TableToNumPyArray(ovTab, ['OVERLAP_OID', 'ORIG_OID']))
+   best = ov['ORIG_OID'].map(srcRank).groupby(ov['OVERLAP_OID']).max()
+   pieceVals = numpy.empty(len(best), dtype=[('PIECE_OID', '<i4'), (field, '<U%d' % max(len(v) for v in values))])
+   pieceVals['PIECE_OID'] = best.index
+   pieceVals[field] = [values[i] for i in best.values]
+   arcpy.da.ExtendTable(pieces, arcpy.Describe(pieces).OIDFieldName, pieceVals, 'PIECE_OID')
+
+   printMsg('Dissolving...')
+   arcpy.PairwiseDissolve_analysis(pieces, outPolys, field, "", "SINGLE_PART")
+   arcpy.Delete_management([pieces, ovTab])
    return outPolys
 
 
@@ -109,6 +108,59 @@ def protMultBMI(bmi, outRast, nlcd=None):
    return outRast
 
 
+def consLandsYear(year, inPolys0, out_gdb, envs):
+   """Creates flattened LPS and BMI feature classes and rasters, and protection multiplier rasters, for one year of
+   conservation lands. Used as the worker function for processing years in parallel, so arcpy environments are set
+   here, and intermediate data are written to a separate scratch geodatabase for each year to avoid lock conflicts.
+   :param year: Year label for outputs
+   :param inPolys0: Conservation lands polygons for the year
+   :param out_gdb: Output geodatabase
+   :param envs: Dictionary of arcpy environment settings (e.g. mask, extent, snapRaster)
+   :return: year
+   """
+   scratchGDB = os.path.dirname(out_gdb) + os.sep + 'scratch_' + year + '.gdb'
+   make_gdb(scratchGDB)
+   with arcpy.EnvManager(workspace=scratchGDB, **envs):
+      # Subset. U is excluded; rec'd by Dave Boyd
+      inPolys = arcpy.MakeFeatureLayer_management(inPolys0, where_clause="BMI <> 'U'")
+
+      # LPS
+      outPolys = out_gdb + os.sep + 'conslands_lps_' + year + '_feat'
+      outRast = out_gdb + os.sep + 'conslands_lps_' + year
+      polyFlatten(inPolys, outPolys, "LPS", values=["4", "3", "2", "1"], scratchGDB=scratchGDB)
+      arcpy.AddField_management(outPolys, "lpsint", "SHORT")
+      arcpy.CalculateField_management(outPolys, "lpsint", "!LPS!", "PYTHON")
+      arcpy.PolygonToRaster_conversion(outPolys, 'lpsint', 'lpsrast')
+      # LPS values are between 1-4; NoData is set to 5 in the same pass
+      rcl = arcpy.sa.RemapValue([[v, v] for v in range(1, 5)] + [['NODATA', 5]])
+      arcpy.sa.Reclassify('lpsrast', 'Value', rcl).save(outRast)
+      # BMI
+      outPolys = out_gdb + os.sep + 'conslands_bmi_' + year + '_feat'
+      outRast = out_gdb + os.sep + 'conslands_bmi_' + year
+      polyFlatten(inPolys, outPolys, "BMI", values=["5", "4", "3", "2", "1"], scratchGDB=scratchGDB)
+      arcpy.AddField_management(outPolys, "bmiint", "SHORT")
+      arcpy.CalculateField_management(outPolys, "bmiint", "!BMI!", "PYTHON")
+      arcpy.PolygonToRaster_conversion(outPolys, 'bmiint', 'bmirast')
+      # BMI values are between 1-5; NoData is set to 6 in the same pass
+      rcl = arcpy.sa.RemapValue([[v, v] for v in range(1, 6)] + [['NODATA', 6]])
+      arcpy.sa.Reclassify('bmirast', 'Value', rcl).save(outRast)
+
+      # Protection multiplier
+      # 1: Protection multiplier, based on LPS and BMI); this was tried as a predictor variable, but ultimately
+      # only was used as an input for the sampling mask.
+      bmiRast = out_gdb + os.sep + 'conslands_bmi_' + year
+      lpsRast = out_gdb + os.sep + 'conslands_lps_' + year
+      outRast = r'D:\git\ConsVision_DevVulnModel\inputs\masks\conslands_pmult_' + year + '.tif'
+      protMult(bmiRast, lpsRast, outRast)
+
+      # 2. BMI-only multiplier (based on BMI only). This was used to adjust raw model values.
+      outRast = r'D:\git\ConsVision_DevVulnModel\inputs\masks\conslands_pmultBMI_' + year + '.tif'
+      protMultBMI(bmiRast, outRast)
+
+   arcpy.Delete_management(scratchGDB)
+   return year
+
+
 def main():
 
    # set environments
@@ -141,43 +193,12 @@ def main():
    conslands_ls = [["2006", os.path.join(out_dir, 'conslands_2006.shp')], ["2016", os.path.join(out_dir, 'conslands_2016.shp')], 
     ["current", conslands_current], ['2023', r'D:\projects\EssentialConSites\quarterly_run\ECS_Run_jun2023\ECS_Inputs_Jun2023.gdb\conslands']]
    
-   for proc in conslands_ls:
-      year = proc[0]
-      inPolys0 = proc[1]
-      # Load conservation lands
-      # if year != 'current':
-      #    inPolys0 = os.path.join(out_dir, 'conslands' + year + '.shp')
-      # else:
-      #    inPolys0 = conslands_current
-      # Subset
-      inPolys = arcpy.MakeFeatureLayer_management(inPolys0, where_clause="BMI <> 'U'")  # U is excluded; rec'd by Dave Boyd
-
-      # LPS
-      outPolys = 'conslands_lps_' + year + '_feat'
-      outRast = 'conslands_lps_' + year
-      polyFlatten(inPolys, outPolys, "LPS", values=["4", "3", "2", "1"])
-      arcpy.AddField_management(outPolys, "lpsint", "SHORT")
-      arcpy.CalculateField_management(outPolys, "lpsint", "!LPS!", "PYTHON")
-      arcpy.PolygonToRaster_conversion(outPolys, 'lpsint', 'lpsrast')
-      arcpy.sa.Con(arcpy.sa.IsNull('lpsrast'), 5, 'lpsrast').save(outRast)  # LPS values are between 1-4
-      # BMI
-      outPolys = 'conslands_bmi_' + year + '_feat'
-      outRast = 'conslands_bmi_' + year
-      polyFlatten(inPolys, outPolys, "BMI", values=["5", "4", "3", "2", "1"])
-      arcpy.AddField_management(outPolys, "bmiint", "SHORT")
-      arcpy.CalculateField_management(outPolys, "bmiint", "!BMI!", "PYTHON")
-      arcpy.PolygonToRaster_conversion(outPolys, 'bmiint', 'bmirast')
-      arcpy.sa.Con(arcpy.sa.IsNull('bmirast'), 6, 'bmirast').save(outRast)  # BMI values are between 1-5
-
-      # Protection multiplier
-      # 1: Protection multiplier, based on LPS and BMI); this was tried as a predictor variable, but ultimately
-      # only was used as an input for the sampling mask.
-      outRast = r'D:\git\ConsVision_DevVulnModel\inputs\masks\conslands_pmult_' + year + '.tif'
-      protMult('conslands_bmi_' + year, 'conslands_lps_' + year, outRast)
-
-      # 2. BMI-only multiplier (based on BMI only). This was used to adjust raw model values.
-      outRast = r'D:\git\ConsVision_DevVulnModel\inputs\masks\conslands_pmultBMI_' + year + '.tif'
-      protMultBMI('conslands_bmi_' + year, outRast)
+   # Years are independent, so each is processed in its own worker process
+   envs = {'mask': msk, 'extent': msk, 'snapRaster': snap, 'outputCoordinateSystem': snap, 'cellSize': snap}
+   with ProcessPoolExecutor(max_workers=len(conslands_ls)) as ex:
+      futures = [ex.submit(consLandsYear, proc[0], proc[1], out_gdb, envs) for proc in conslands_ls]
+      for f in as_completed(futures):
+         print('Finished conservation lands for ' + f.result() + '.')
 
 
    ## Create a distance to protected areas layer to use as a model variable.
@@ -14,9 +14,14 @@ Usage Notes:
 by '_' (e.g. '06_16' for 2006/2016).
 """
 from Helper import *
+from scipy import ndimage
 
+# Let parallel-capable Spatial Analyst tools (e.g. EucDistance, Reclassify) use every core
+arcpy.env.parallelProcessingFactor = "100%"
 
-def MakeWeightKernel(out_File, nCells, gamma, scale=100, rounding=3, ysnInt=0, centerVal=0, annDist=10):
+
+def MakeWeightKernel(out_File, nCells, gamma, scale=100, rounding=3, ysnInt=0, centerVal=0, annDist=10,
+                     returnArrays=False):
    '''Creates a weighted neighborhood kernel, in which the influence of cells in a circular neighborhood decays with
    (cell) distance. The output is a properly formatted text file that can be used in the ArcGIS Focal Statistics tool
    for the "Weight" neighborhood option.
@@ -43,37 +48,36 @@ def MakeWeightKernel(out_File, nCells, gamma, scale=100, rounding=3, ysnInt=0, c
    - centerVal: Indicator of whether focal cell influences the output (1) or not (0)
    - annDist: The inner radius of the annulus neighborhood. Cells within this radius are set to the centerVal.
       Cells at the edge of this radius get the maximum weight, and weight decays outwards from there.
+   - returnArrays: Whether to return the (scale, distance, weight, normalized weight) arrays (True), or only write
+      the output file and return None (False)
    '''
    # Set up array and do all the calculations
    diam = 2 * nCells + 1
    maxDist = nCells + 0.5
    dims = (diam, diam)
-   s = numpy.zeros(dims)
-   s += scale
-   (ycoords, xcoords) = numpy.where(s)
-   ycoords.shape = dims
-   xcoords.shape = dims
-   midY = ycoords.max() / 2
-   midX = xcoords.max() / 2
-   d = numpy.sqrt((xcoords - midX) ** 2 + (ycoords - midY) ** 2)
-   weight = numpy.where(d > maxDist, 0, numpy.where(d <= annDist, centerVal * scale, s / (d - annDist) ** gamma))
+   # Distance from the center cell, from broadcasting row and column offsets. Single precision is ample for weights
+   # rounded to a few decimal places.
+   y, x = numpy.ogrid[-nCells:nCells + 1, -nCells:nCells + 1]
+   d = numpy.hypot(x, y, dtype='float32')
+   weight = numpy.zeros(dims, dtype='float32')
+   weight[(d <= annDist) & (d <= maxDist)] = centerVal * scale
+   ring = (d > annDist) & (d <= maxDist)
+   weight[ring] = scale / (d[ring] - annDist) ** gamma
    normWt = scale * weight / numpy.sum(weight)
    if ysnInt == 1:
-      normWt = numpy.around(normWt)
+      normWt = numpy.around(normWt).astype('int32')
+      fmt = '%d'
    else:
       normWt = numpy.around(normWt, rounding)
+      fmt = '%s'
 
    # Write to output file
-   outfile = open(out_File, 'w')
    first_line = str(dims[1]) + ' ' + str(dims[0])
-   outfile.write(first_line)
-   for row in normWt:
-      outfile.write('\n')
-      for column in row:
-         outfile.write(str(column) + '    ')
-   outfile.close()
+   numpy.savetxt(out_File, normWt, fmt=fmt, delimiter='    ', header=first_line, comments='')
 
-   return (s, d, weight, normWt)
+   if returnArrays:
+      s = numpy.full(dims, scale, dtype='float32')
+      return (s, d, weight, normWt)
 
 
 def MakeKernelList(out_Dir):
@@ -111,15 +115,7 @@ def MultiWeightKernels(parmsList):
    for p in parmsList:
       out_File = p[0]
       print(out_File)
-      nCells = p[1]
-      gamma = p[2]
-      scale = p[3]
-      rounding = p[4]
-      ysnInt = p[5]
-      centerVal = p[6]
-      annDist = p[7]
-
-      MakeWeightKernel(out_File, nCells, gamma, scale, rounding, ysnInt, centerVal, annDist)
+      MakeWeightKernel(*p)
       out = [arcpy.sa.NbrWeight(out_File), os.path.basename(out_File).replace('.txt', '')]
       outList.append(out)
 
@@ -163,8 +159,7 @@ def NewRoadDist(t1, t2, year, keep_intermediate=False):
    - t1: Impervious descriptor raster in time 1
    - t2: Impervious descriptor raster in time 2
    - year: Year suffix added to output dataset
-   - keep_intermediate: Whether intermediate rasters should be saved (True), or deleted (False)
-   - edist: Whether to run Euclidean distance on the hotspots output. (file will have '_edist' suffix)
+   - keep_intermediate: Whether intermediate rasters should be saved (True), or not written at all (False)
    """
 
    # set up naming scheme
@@ -172,11 +167,13 @@ def NewRoadDist(t1, t2, year, keep_intermediate=False):
 
    # Create difference raster
    print('Generating binary road rasters...')
-   arcpy.sa.Con(t1, 1, 0, 'Value IN (20, 21, 22, 23)').save('T1')
-   arcpy.sa.Con(t2, 1, 0, 'Value IN (20, 21, 22, 23)').save('T2')
+   road1 = arcpy.sa.Con(t1, 1, 0, 'Value IN (20, 21, 22, 23)')
+   road2 = arcpy.sa.Con(t2, 1, 0, 'Value IN (20, 21, 22, 23)')
+   if keep_intermediate:
+      road1.save('T1')
+      road2.save('T2')
    print('Generating new road raster `' + nm + '`...')
-   arcpy.sa.Minus('T2', 'T1').save('tmp_minus')
-   arcpy.sa.SetNull('tmp_minus', 1, 'Value <> 1').save(nm + '_' + year)
+   arcpy.sa.SetNull((road2 - road1) != 1, 1).save(nm + '_' + year)
 
    print('Calculating euclidean distance...')
    arcpy.sa.EucDistance(nm + '_' + year).save('tmp_ed')
@@ -184,14 +181,26 @@ def NewRoadDist(t1, t2, year, keep_intermediate=False):
    arcpy.BuildPyramids_management(nm + '_edist_' + year)
 
    # clean up
-   arcpy.Delete_management(['tmp_minus', 'tmp_ed'])
-   # delete intermediate
-   if not keep_intermediate:
-      arcpy.Delete_management(['T1', 'T2'])
+   arcpy.Delete_management('tmp_ed')
 
    return nm
 
 
+def ArrayToRaster(arr, templ, out, nodata=None):
+   """Saves a NumPy array as a raster, using the position, cell size, and coordinate system of a template raster with
+   the same dimensions.
+   Parameters:
+   - arr: Input NumPy array
+   - templ: Template raster object (e.g. the raster the array was read from)
+   - out: Output raster
+   - nodata: Value in arr to set to NoData
+   """
+   arcpy.NumPyArrayToRaster(arr, templ.extent.lowerLeft, templ.meanCellWidth, templ.meanCellHeight,
+                            nodata).save(out)
+   arcpy.DefineProjection_management(out, templ.spatialReference)
+   return out
+
+
 def ImpGrowthSpots(t1, t2, year, cutoff=20, areamin=20000, keep_intermediate=False, edist=False):
    """Generate Impervious area growth spots, based on two time periods from NLCD.
    Parameters:
@@ -201,7 +210,7 @@ def ImpGrowthSpots(t1, t2, year, cutoff=20, areamin=20000, keep_intermediate=Fal
       a potential hotspot
    - areamin = The minimum area, in square map units (typically meters), required for a contiguous cluster of potential
       hotspot cells to be considered a hotspot.
-   - keep_intermediate: Whether intermediate rasters should be saved (True), or deleted (False)
+   - keep_intermediate: Whether intermediate rasters should be saved (True), or not written at all (False)
    - edist: Whether to run Euclidean distance on the hotspots output. (file will have '_edist' suffix)
    """
 
@@ -211,35 +220,58 @@ def ImpGrowthSpots(t1, t2, year, cutoff=20, areamin=20000, keep_intermediate=Fal
    # Create difference raster
    print('Generating hotspots raster `' + nm + '`...')
 
-   # Difference
-   arcpy.sa.Minus(t2, t1).save('Diff_' + nm)
-
-   # Filter, reclassify, and group cells
-   arcpy.sa.Filter('Diff_' + nm, 'LOW', 'DATA').save('FDiff_' + nm)
-   mx = arcpy.GetRasterProperties_management('Diff_' + nm, 'MAXIMUM')
-   if int(mx[0]) < cutoff:
+   # Difference. This uses map algebra so that processing environments (extent, mask, cell size) are applied, then all
+   # further steps are done in a single in-memory pass over the array.
+   diffRast = arcpy.sa.Minus(t2, t1)
+   diff = arcpy.RasterToNumPyArray(diffRast, nodata_to_value=-32768).astype('int32')
+   if keep_intermediate:
+      diffRast.save('Diff_' + nm)
+   # NoData cells hold the lowest possible value, so they never affect the maximum
+   if diff.max() < cutoff:
       print('No output: no areas are above the cutoff threshold. Consider using a lower `cutoff` value.')
       return
-   arcpy.sa.Con('FDiff_' + nm, 1, None, 'Value >= ' + str(cutoff)).save('Pot_' + nm)
-   arcpy.sa.RegionGroup('Pot_' + nm, 'EIGHT', 'WITHIN').save('Regions_' + nm)
+
+   valid = diff != -32768
+
+   # Filter (3x3 low pass, ignoring NoData cells), reclassify, and group cells. Sums are compared to the cutoff times
+   # the number of cells with data, which is equivalent to comparing the filtered mean, without rounding error.
+   diff[~valid] = 0
+   kernel = numpy.ones((3, 3), dtype='int32')
+   sums = ndimage.correlate(diff, kernel, mode='constant', cval=0)
+   counts = ndimage.correlate(valid.astype('int32'), kernel, mode='constant', cval=0)
+   del diff
+   pot = valid & (sums >= cutoff * counts)
+   if keep_intermediate:
+      ArrayToRaster(numpy.where(valid, sums / numpy.maximum(counts, 1), -9999).astype('float32'), diffRast,
+                    'FDiff_' + nm, -9999)
+      ArrayToRaster(pot.astype('uint8'), diffRast, 'Pot_' + nm, 0)
+   del sums, counts
+   regions = ndimage.label(pot, structure=numpy.ones((3, 3)))[0]
+   del pot
 
    print('Calculating areas of regions, removing those smaller than threshold...')
-   arcpy.sa.ZonalGeometry('Regions_' + nm, 'VALUE', 'AREA').save('Area_' + nm)
-   arcpy.sa.Con('Area_' + nm, 1, None, 'Value >= ' + str(areamin)).save(nm)
+   area = numpy.bincount(regions.ravel()) * (diffRast.meanCellWidth * diffRast.meanCellHeight)
+   keep = area >= areamin
+   keep[0] = False
+   if keep_intermediate:
+      ArrayToRaster(regions, diffRast, 'Regions_' + nm, 0)
+      ArrayToRaster(numpy.where(regions > 0, area[regions], 0), diffRast, 'Area_' + nm, 0)
+   hot = keep[regions]
+   del regions
+   ArrayToRaster(hot.astype('uint8'), diffRast, nm, 0)
    arcpy.BuildPyramids_management(nm)
 
    if edist:
-      print('Calculating euclidean distance...')
-      arcpy.sa.EucDistance(nm).save('tmp_ed')
-      arcpy.sa.Int(arcpy.sa.Raster('tmp_ed') + 0.5).save(label + '_edist_' + year)
-      arcpy.BuildPyramids_management(label + '_edist_' + year)
-      arcpy.Delete_management('tmp_ed')
-
-   # delete intermediate
-   if not keep_intermediate:
-      ls = ['Diff_', 'FDiff_', 'Pot_', 'Regions_', 'Area_']
-      ls = [s + nm for s in ls]
-      arcpy.Delete_management(ls)
+      if not hot.any():
+         print('No hotspots, skipping euclidean distance.')
+      else:
+         print('Calculating euclidean distance...')
+         # Distance from each cell center to the nearest hotspot cell center, rounded to integer map units
+         dist = ndimage.distance_transform_edt(~hot, sampling=(diffRast.meanCellHeight, diffRast.meanCellWidth))
+         dist = numpy.where(valid, numpy.floor(dist + 0.5), -1).astype('int32')
+         ArrayToRaster(dist, diffRast, label + '_edist_' + year, -1)
+         del dist
+         arcpy.BuildPyramids_management(label + '_edist_' + year)
 
    return nm
 
@@ -253,17 +285,19 @@ def EucDistNLCD(nlcd, classes, year, maxDist=None):
    - maxDist: maximum distance for Euclidean Distance (map units)
    """
 
+   # Read land cover once (map algebra applies the processing environments); class masks are then made in memory
+   lcRast = arcpy.sa.Int(nlcd)
+   lc = arcpy.RasterToNumPyArray(lcRast, nodata_to_value=0)
+
    ls = []
    for cl in classes:
-      q = ','.join([str(l) for l in cl[0]])
       suf = cl[1]
 
       nm = 'edist_' + suf + '_' + year
       print('Working on raster `' + nm + '`...')
 
       # process raster
-      query = "Value NOT IN  (" + q + ")"
-      arcpy.sa.SetNull(nlcd, nlcd, query).save('sn')
+      ArrayToRaster(numpy.isin(lc, numpy.asarray(cl[0], dtype=lc.dtype)).astype('uint8'), lcRast, 'sn', 0)
       arcpy.sa.EucDistance('sn', maxDist).save('ed')
       arcpy.sa.Int(arcpy.sa.Raster('ed') + 0.5).save(nm)
       ls.append(nm)
@@ -10,6 +10,9 @@ It also includes the steps used to make water/developed masks for adjusting the
 """
 from Helper import *
 
+# Mask and change rasters span the full study area, so run supported tools on all cores
+arcpy.env.parallelProcessingFactor = "100%"
+
 
 def devChgImp(t1, t2, out, develmin=1, keep_intermediate=False):
    """Generate development change status raster, based on impervious surface percentage from two time periods from NLCD.
@@ -21,31 +24,26 @@ def devChgImp(t1, t2, out, develmin=1, keep_intermediate=False):
    - t1: Impervious raster in time 1
    - t2: Impervious raster in time 2
    - develmin = The minimum imperviousness (in percent), for a cell to be considered developed
-   - keep_intermediate: Whether intermediate rasters should be saved (True), or deleted (False)
+   - keep_intermediate: Whether the development status rasters should be saved (True), or not written (False)
    """
 
-   # make binary rasters
-   r1 = os.path.basename(t1) + '_DevStat'
-   r2 = os.path.basename(t2) + '_DevStat'
-
-   print('Generating development status rasters...')
-   remap = RemapRange([[0, develmin - 0.1, 0], [develmin - 0.1, 100.1, 1]])
-   arcpy.sa.Reclassify(t1, "Value", remap, missing_values="NODATA").save(r1)
-   remap = RemapRange([[0, develmin - 0.1, 0], [develmin - 0.1, 100.1, 1]])
-   arcpy.sa.Reclassify(t2, "Value", remap, missing_values="NODATA").save(r2)
-
    print('Generating impervious change raster `' + out + '`...')
-   rchg = Raster(r1) + (Raster(r2) * 100)
+   # Development status (0/1) for each time period, as map algebra so both feed a single reclassify. Values above 100
+   # (e.g. 127 = NoData in NLCD impervious) remain NoData.
+   ras1 = Raster(t1)
+   ras2 = Raster(t2)
+   b1 = arcpy.sa.Con(ras1 <= 100, ras1 >= develmin)
+   b2 = arcpy.sa.Con(ras2 <= 100, ras2 >= develmin)
+   if keep_intermediate:
+      b1.save(os.path.basename(t1) + '_DevStat')
+      b2.save(os.path.basename(t2) + '_DevStat')
+   rchg = b1 + (b2 * 100)
    remap = RemapValue([[0, 0], [1, 3], [100, 1], [101, 2]])
    arcpy.sa.Reclassify(rchg, 'Value', remap, missing_values="NODATA").save(out)
    arcpy.BuildPyramids_management(out)
 
    print('Cleaning up...')
    arcpy.Delete_management(rchg)
-   # delete intermediate
-   if not keep_intermediate:
-      ls = [r1, r2]
-      arcpy.Delete_management(ls)
 
    return out
 
@@ -60,17 +58,15 @@ def makeSampMask(exclList, outRast, mask=None):
    """
    with arcpy.EnvManager(mask=mask):
       print('Making sampling mask `' + outRast + '`...')
-      ct = 0
-      nmList = []
+      # Each exclusion is 1/NoData, so their product is NoData wherever any exclusion (or NoData) is hit. This is
+      # evaluated as one expression, without writing a raster per exclusion.
+      msk = None
       for ex in exclList:
-         print('Processing raster `' + os.path.basename(ex[0]) + '`...')
-         nm = 'tmpMsk' + str(ct)
-         arcpy.sa.SetNull(ex[0], 1, ex[1]).save(nm)
-         nmList.append(nm)
-         ct += 1
-      arcpy.sa.CellStatistics(nmList, 'MAXIMUM', 'NODATA').save(outRast)
+         print('Adding exclusions from raster `' + os.path.basename(ex[0]) + '`...')
+         exRast = arcpy.sa.SetNull(ex[0], 1, ex[1])
+         msk = exRast if msk is None else msk * exRast
+      msk.save(outRast)
       arcpy.BuildPyramids_management(outRast)
-      arcpy.Delete_management(nmList)
 
 
 def makeStrataFeat(inFeat, outFeat, inBnd, trainPercentage=50):